@@ -1,6 +1,6 @@
 import torch
 import torch.nn as nn
-from torch.nn.functional import log_softmax
+from torch.nn.functional import linear, log_softmax
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, PackedSequence
 
 
@@ -19,6 +19,57 @@ def is_time_decrease(layer):
     return decrease_dim(100, layer) != 100
 
 
+def fuse_linear_bn(lin, bn):
+    """
+    Fold an eval mode BatchNorm1d into the Linear layer that precedes it.
+    :return: Weight and bias such that linear(x, weight, bias) == bn(lin(x))
+             with the running statistics
+    """
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        bias = bn.bias - bn.running_mean * scale
+        if lin.bias is not None:
+            bias = bias + lin.bias * scale
+        weight = lin.weight * scale[:, None]
+    return weight, bias
+
+
+def lazy_script(fn):
+    """
+    Compile fn with TorchScript on its first call instead of at import,
+    falling back to the eager function if scripting is not supported.
+    """
+    compiled = []
+
+    def wrapper(*args):
+        if not compiled:
+            try:
+                compiled.append(torch.jit.script(fn))
+            except Exception:
+                compiled.append(fn)
+        return compiled[0](*args)
+
+    return wrapper
+
+
+@lazy_script
+def select3(mask, a0, a1, a2, b0, b1, b2):
+    return torch.where(mask, a0, b0), torch.where(mask, a1, b1), torch.where(mask, a2, b2)
+
+
+@lazy_script
+def decode_step(z, sampled: bool, epsilon: float):
+    if sampled:
+        c = torch.multinomial(z.exp(), num_samples=1).view(-1)
+        if epsilon > 0:
+            e = torch.bernoulli(torch.ones_like(c) * epsilon)
+            r = torch.argmax(torch.randn_like(z), dim=-1)
+            c = torch.where(e != 0, r, c)
+    else:
+        c = torch.argmax(z, dim=-1)
+    return c
+
+
 class MaskConv(nn.Module):
 
     def __init__(self, layers):
@@ -29,6 +80,11 @@ class MaskConv(nn.Module):
         """
         super(MaskConv, self).__init__()
         self.layers = layers
+        # layer properties are fixed, so resolve them once instead of per forward
+        self.time_decrease = [is_time_decrease(layer) for layer in layers]
+        # ReLU and Dropout map zeros to zeros, so only the outputs of the other
+        # layers (conv, batch norm) can bring back non-zero padding
+        self.needs_mask = [not isinstance(layer, (nn.ReLU, nn.Dropout)) for layer in layers]
 
     def output_time(self, x):
         for layer in self.layers:
@@ -52,35 +108,73 @@ class MaskConv(nn.Module):
 
         mask = None
 
-        for layer in self.layers:
+        for layer, time_decrease, needs_mask in zip(self.layers, self.time_decrease,
+                                                    self.needs_mask):
 
             x = layer(x)
 
-            if is_time_decrease(layer):
+            if time_decrease:
 
                 lengths = decrease_dim(lengths, layer)
 
                 n, c, d, t = x.size()
 
-                mask = torch.zeros((n, 1, 1, t), dtype=torch.bool, device=x.device)
+                mask = torch.arange(t, device=x.device)[None, :] >= lengths[:, None]
+                mask = mask.view(n, 1, 1, t)
 
-                for i, length in enumerate(lengths):
-                    start = length.item()
-                    length = t - start
-                    if length > 0:
-                        mask[i].narrow(2, start, length).fill_(1)
-
-            if mask is not None:
-                x = x.masked_fill(mask, 0)
+            if mask is not None and needs_mask:
+                x.masked_fill_(mask, 0)
 
+        # one copy to T x N x H from either NCHW or channels_last layout
         n, c, d, t = x.size()
-        x = x.view(n, c * d, t)
-        x = x.transpose(1, 2).transpose(0, 1).contiguous()  # T x N x H
+        x = x.permute(3, 0, 1, 2).contiguous().view(t, n, c * d)  # T x N x H
 
         return x, lengths
 
 
-class AcousticModel(nn.Module):
+class ProjectionHead(nn.Module):
+
+    def __init__(self):
+        """
+        Base of the models ending with prj (Dropout, Linear) and
+        fc (BatchNorm1d, ReLU, Linear), which can fold the BatchNorm
+        into the projection for inference.
+        """
+        super(ProjectionHead, self).__init__()
+        self.fused = None
+
+    def project(self, x, head=True):
+        if not head:
+            return self.prj(x)
+        if self.fused is not None and not self.training:
+            return self.fc[1:](linear(x, *self.fused))
+        return self.fc(self.prj(x))
+
+    def fuse_for_inference(self):
+        """
+        Fold the BatchNorm of the head into the projection for inference.
+        The fold is a snapshot of the weights and is dropped whenever they
+        may change: on train(), load_state_dict() and .to()/.cuda()/.half().
+        """
+        self.eval()
+        self.fused = fuse_linear_bn(self.prj[1], self.fc[0])
+        return self
+
+    def train(self, mode=True):
+        if mode:
+            self.fused = None
+        return super(ProjectionHead, self).train(mode)
+
+    def _apply(self, *args, **kwargs):
+        self.fused = None
+        return super(ProjectionHead, self)._apply(*args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.fused = None
+        return super(ProjectionHead, self)._load_from_state_dict(*args, **kwargs)
+
+
+class AcousticModel(ProjectionHead):
 
     def __init__(self, input_size, hidden_size, prj_size, output_size,
                  n_layers=1, dropout=0, checkpoint=''):
@@ -91,6 +185,8 @@ class AcousticModel(nn.Module):
             nn.Conv2d(32, 32, kernel_size=(11, 11), stride=(2, 1), padding=(5, 5), bias=False),
             nn.BatchNorm2d(32), nn.ReLU(inplace=True), nn.Dropout(dropout)
         ))
+        # NHWC lets cuDNN pick its tensor core conv kernels
+        self.conv.to(memory_format=torch.channels_last)
         input_size = self.conv.output_dim(input_size)
         self.rnn = nn.GRU(input_size, hidden_size, n_layers,
                           dropout=dropout if n_layers > 1 else 0,
@@ -105,23 +201,26 @@ class AcousticModel(nn.Module):
 
     def forward(self, x, lengths, head=True):
         # Apply 2d convolutions
+        x = x.contiguous(memory_format=torch.channels_last)
         x, lengths = self.conv(x, lengths)
-        # Pack padded batch of sequences for RNN module
-        x = pack_padded_sequence(x, lengths)
+        # Pack padded batch of sequences for RNN module; the lengths stay on
+        # the device through the conv stack, this is their only host copy
+        x = pack_padded_sequence(x, lengths.cpu())
         # Forward pass through GRU
         x, _ = self.rnn(x)
-        # Sum bidirectional GRU outputs
+        # Sum bidirectional GRU outputs; without autograd the GRU output is
+        # not needed afterwards, so the sum can reuse its memory
         f, b = x.data.split(self.rnn.hidden_size, 1)
-        data = self.prj(f + b)
+        fb = f + b if torch.is_grad_enabled() else f.add_(b)
+        data = self.project(fb, head)
         if head:
-            data = self.fc(data)
             data = log_softmax(data, dim=-1)
         x = PackedSequence(data, x.batch_sizes, x.sorted_indices, x.unsorted_indices)
         x, _ = pad_packed_sequence(x)
         return x, lengths
 
 
-class LanguageModel(nn.Module):
+class LanguageModel(ProjectionHead):
 
     def __init__(self, emb_size, hidden_size, prj_size, vocab_size,
                  n_layers=1, dropout=0, blank=0, checkpoint=''):
@@ -139,29 +238,37 @@ class LanguageModel(nn.Module):
             self.load_state_dict(torch.load(checkpoint, map_location='cpu'))
 
     def forward(self, x, lengths, head=True):
-        init = torch.zeros((1, x.shape[1]), device=x.device, dtype=torch.long)
-        x = torch.cat([init, x.long()])
-        x = self.emb(x)
-        x = pack_padded_sequence(x, lengths + 1, enforce_sorted=False)
+        # packing needs host lengths; fetch them before any LM kernel is queued
+        lengths = lengths.cpu() + 1
+        # prepend the blank (zero) step without a cat
+        t, n = x.shape
+        buf = torch.empty((t + 1, n), device=x.device, dtype=torch.long)
+        buf[0].zero_()
+        buf[1:].copy_(x)
+        x = self.emb(buf)
+        x = pack_padded_sequence(x, lengths, enforce_sorted=False)
         x, _ = self.rnn(x)
-        data = self.prj(x.data)
+        data = self.project(x.data, head)
         if head:
-            data = self.fc(data)
             data = log_softmax(data, dim=-1)
         x = PackedSequence(data, x.batch_sizes, x.sorted_indices, x.unsorted_indices)
         x, _ = pad_packed_sequence(x)
         return x
 
-    def step_features(self, x, h=None):
+    def step_rnn(self, x, h=None):
         x = self.emb(x)
         x, h = self.rnn(x, h)
+        return x, h
+
+    def step_features(self, x, h=None):
+        x, h = self.step_rnn(x, h)
         x = self.prj(x)
         return x, h
 
     def step_forward(self, x, h=None):
-        x, h = self.step_features(x, h)
+        x, h = self.step_rnn(x, h)
         x = x.view(-1, x.size(-1))
-        x = self.fc(x)  # T x N x H
+        x = self.project(x)  # T x N x H
         return x, h
 
     def step_init(self, batch_size):
@@ -199,6 +306,9 @@ class Transducer(nn.Module):
         self.stream_am = torch.cuda.Stream()
         self.stream_lm = torch.cuda.Stream()
 
+        # captured LM steps of greedy_decode, reused across calls
+        self.decode_graphs = {}
+
     def forward_acoustic(self, xs, xn):
         xs, xn = self.am(xs, xn, head=False)
         xs = xs.transpose(0, 1)
@@ -210,78 +320,173 @@ class Transducer(nn.Module):
         return ys
 
     def forward_joint(self, xs, ys):
-        # align
-        n, t, x_h = xs.size()
-        n, u, y_h = ys.size()
-        x = xs.unsqueeze(dim=2).expand(torch.Size([n, t, u, x_h]))
-        y = ys.unsqueeze(dim=1).expand(torch.Size([n, t, u, y_h]))
+        # align: N x T x 1 x H + N x 1 x U x H broadcasts to N x T x U x H
+        x = xs.unsqueeze(dim=2)
+        y = ys.unsqueeze(dim=1)
         # predict
         zs = self.joint(x, y)
         return zs
 
+    def joint_logits(self, x, y):
+        return self.fc(x + y)
+
     def joint(self, x, y):
-        z = self.fc(x + y)
+        z = self.joint_logits(x, y)
         z = log_softmax(z, dim=-1)
         return z
 
     def forward(self, xs, ys, xn, yn):
         # wait all inputs
-        torch.cuda.synchronize()
+        ev_in = torch.cuda.Event()
+        ev_in.record()
+        # language model goes first: its only host sync is on the input
+        # lengths, while the acoustic model waits for the conv output lengths
+        with torch.cuda.stream(self.stream_lm):
+            self.stream_lm.wait_event(ev_in)
+            ys = self.forward_language(ys, yn)
+            ev_lm = torch.cuda.Event()
+            ev_lm.record()
         # acoustic model
         with torch.cuda.stream(self.stream_am):
+            self.stream_am.wait_event(ev_in)
             xs, xn = self.forward_acoustic(xs, xn)
-        # language model
-        with torch.cuda.stream(self.stream_lm):
-            ys = self.forward_language(ys, yn)
+            ev_am = torch.cuda.Event()
+            ev_am.record()
         # synchronize two flows
-        torch.cuda.synchronize()
+        stream = torch.cuda.current_stream()
+        stream.wait_event(ev_am)
+        stream.wait_event(ev_lm)
         # joint
         zs = self.forward_joint(xs, ys)
         return zs, xs, xn
 
-    def greedy_decode(self, xs, prior=None, sampled=False, epsilon=0, argmax=True):
+    def clear_decode_graphs(self):
+        """
+        Release the CUDA graphs captured by greedy_decode and their memory pools.
+        """
+        self.decode_graphs.clear()
+
+    def _apply(self, *args, **kwargs):
+        # captured graphs hold raw pointers to the current parameter storage
+        self.clear_decode_graphs()
+        return super(Transducer, self)._apply(*args, **kwargs)
+
+    def step_graph(self, n, device):
+        """
+        Capture a single LM step for a batch of size n into a CUDA graph.
+        Capturing synchronizes the device, so the step is captured once per
+        batch size and reused by later calls.
+        :return: Callable with the signature of LanguageModel.step_features,
+                 whose outputs are overwritten by the next call
+        """
+        key = (n, device, next(self.lm.parameters()).dtype, self.lm.training)
+        if key in self.decode_graphs:
+            return self.decode_graphs[key]
+        c = torch.zeros((1, n), device=device, dtype=torch.long)
+        h = self.lm.step_init(n)
+        # warm up on a side stream before capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            self.lm.step_features(c, h)
+        torch.cuda.current_stream().wait_stream(stream)
+        graph = torch.cuda.CUDAGraph()
+        # only this thread's CUDA calls matter, not e.g. the pin_memory thread
+        with torch.cuda.graph(graph, capture_error_mode='thread_local'):
+            y, h_next = self.lm.step_features(c, h)
+
+        def step(c_new, h_new):
+            c.copy_(c_new)
+            h[0].copy_(h_new[0])
+            h[1].copy_(h_new[1])
+            graph.replay()
+            return y, h_next
+
+        self.decode_graphs[key] = step
+        return step
+
+    def greedy_decode(self, xs, prior=None, sampled=False, epsilon=0, argmax=True,
+                      graph=True, chunk=None):
 
         n, t, h = xs.size()
 
+        # replaying a captured LM step saves the per-kernel launch overhead
+        if graph and xs.is_cuda and not torch.is_grad_enabled():
+            lm_step = self.step_graph(n, xs.device)
+        else:
+            lm_step = self.lm.step_features
+
+        # T-major so that each step writes one contiguous row
         if argmax:
-            s = torch.zeros((n, t), device=xs.device, dtype=torch.int)
+            s = torch.zeros((t, n), device=xs.device, dtype=torch.int)
         else:
-            s = torch.zeros((n, t, self.vocab_size), device=xs.device, dtype=torch.float)
+            s = torch.zeros((t, n, self.vocab_size), device=xs.device, dtype=torch.float)
 
         c = torch.zeros((1, n), device=xs.device, dtype=torch.long)
 
         yd, (hd, cd) = self.lm.step_features(c)
 
-        for i in range(t):
+        # log_softmax only shifts each row by a constant, so the argmax
+        # (also after subtracting a per-class prior) can use raw logits
+        normalize = sampled or not argmax
+
+        # Frames up to the first non-blank share the same LM state, so the
+        # joint runs over a chunk of frames at once and the decode advances
+        # past the first frame where any sequence emits. Chunks mostly pay off
+        # for single utterances, where long all-blank runs are common.
+        if chunk is None:
+            chunk = 8 if n == 1 else 1
+
+        # The search for the first emission costs a host sync per chunk. For
+        # single frames of a batch it almost never finds an all-blank frame,
+        # so it only runs for chunks or single utterances.
+        search = chunk > 1 or n == 1
+
+        i = 0
+
+        while i < t:
+
+            k = min(chunk, t - i)
 
-            z = self.joint(xs[:, i], yd[0])
+            x = xs[:, i:i + k]
+            y = yd[0].unsqueeze(1)
+
+            if normalize:
+                z = self.joint(x, y)
+            else:
+                z = self.joint_logits(x, y)
 
             if prior is not None:
                 z -= prior
 
-            if sampled:
-                c = torch.multinomial(z.exp(), num_samples=1).view(n)
-                if epsilon > 0:
-                    e = torch.bernoulli(torch.ones_like(c) * epsilon)
-                    r = torch.argmax(torch.randn_like(z), dim=-1)
-                    c = torch.where(e.bool(), r, c)
-            else:
-                c = torch.argmax(z, dim=-1)
+            c = decode_step(z.view(n * k, -1), sampled, float(epsilon)).view(n, k)
 
+            # frames past the first emission are rewritten by later chunks
             if argmax:
-                s[:, i] = c
+                s[i:i + k] = c.t()
             else:
-                s[:, i] = z
+                s[i:i + k] = z.transpose(0, 1)
+
+            if search:
+                # index of the first frame with any emission, k if there is none
+                emitted = (c != self.blank).any(dim=0)
+                m = int(torch.cat([emitted, emitted.new_ones(1)]).int().argmax())
+                # the LM state does not advance on blank
+                if m == k:
+                    i += k
+                    continue
+            else:
+                m = 0
+
+            c = c[:, m].reshape(1, n)
 
-            c = c.view(1, n)
+            # 1 x N x 1 broadcasts over both yd and (hd, cd)
+            mask = (c == self.blank).unsqueeze(-1)
 
-            mask = c == self.blank
-            mask = mask.unsqueeze(-1)
+            yd_next, (hd_next, cd_next) = lm_step(c, (hd, cd))
 
-            yd_next, (hd_next, cd_next) = self.lm.step_features(c, (hd, cd))
+            yd, hd, cd = select3(mask, yd, hd, cd, yd_next, hd_next, cd_next)
 
-            yd = torch.where(mask, yd, yd_next)
-            hd = torch.where(mask, hd, hd_next)
-            cd = torch.where(mask, cd, cd_next)
+            i += m + 1
 
-        return s
+        return s.transpose(0, 1).contiguous()
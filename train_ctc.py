@@ -51,7 +51,8 @@ for epoch in range(1, 21):
 
         step += 1
 
-        xs, xn = model(xs, xn)
+        with torch.autocast('cuda', dtype=torch.bfloat16):
+            xs, xn = model(xs, xn)
 
         loss1 = ctc_loss(xs, ys, xn, yn).mean()
 
@@ -103,7 +104,8 @@ for epoch in range(1, 21):
 
         for xs, ys, xn, yn in dev:
 
-            xs, xn = model(xs, xn)
+            with torch.autocast('cuda', dtype=torch.bfloat16):
+                xs, xn = model(xs, xn)
 
             xs = xs.exp().view(-1, len(labels))
 
@@ -120,7 +122,8 @@ for epoch in range(1, 21):
 
         for xs, ys, xn, yn in test:
 
-            xs, xn = model(xs, xn)
+            with torch.autocast('cuda', dtype=torch.bfloat16):
+                xs, xn = model(xs, xn)
 
             loss1 = ctc_loss(xs, ys, xn, yn).mean()
 
@@ -80,9 +80,10 @@ for epoch in range(1, 11):
 
         optimizer.zero_grad()
 
-        output, hidden = model.step_forward(inputs, hidden)
+        with torch.autocast('cuda', dtype=torch.bfloat16):
+            output, hidden = model.step_forward(inputs, hidden)
 
-        loss = criterion(output, targets.view(-1))
+        loss = criterion(output.float(), targets.view(-1))
         loss.backward()
 
         grad_norm = nn.utils.clip_grad_norm_(model.parameters(), 1)
@@ -116,9 +117,10 @@ for epoch in range(1, 11):
 
         for inputs, targets in loader:
 
-            output, hidden = model.step_forward(inputs, hidden)
+            with torch.autocast('cuda', dtype=torch.bfloat16):
+                output, hidden = model.step_forward(inputs, hidden)
 
-            loss = criterion(output, targets.view(-1))
+            loss = criterion(output.float(), targets.view(-1))
 
             err.update(loss.item())
 
@@ -59,7 +59,8 @@ with torch.no_grad():
 
     for xs, ys, xn, yn in dev:
 
-        xs, xn = model.forward_acoustic(xs, xn)
+        with torch.autocast('cuda', dtype=torch.bfloat16):
+            xs, xn = model.forward_acoustic(xs, xn)
 
         xs = model.greedy_decode(xs, argmax=False)
 
@@ -92,7 +93,8 @@ for epoch in range(1, 11):
 
         with torch.no_grad():
 
-            hs, hn = model.forward_acoustic(xs, xn)
+            with torch.autocast('cuda', dtype=torch.bfloat16):
+                hs, hn = model.forward_acoustic(xs, xn)
 
             hs_k = hs.repeat(K, 1, 1)
             hn_k = hn.repeat(K)
@@ -120,7 +122,8 @@ for epoch in range(1, 11):
 
         model.train()
 
-        zs, xs, xn = model(xs, ys.t(), xn, yn)
+        with torch.autocast('cuda', dtype=torch.bfloat16):
+            zs, xs, xn = model(xs, ys.t(), xn, yn)
 
         loss1 = rnnt_loss(zs, ys, xn, yn).mean()
 
@@ -133,9 +136,10 @@ for epoch in range(1, 11):
 
             ys = ys[:, :yn.max()].contiguous()
 
-            zs = model.forward_language(ys.t(), yn)
+            with torch.autocast('cuda', dtype=torch.bfloat16):
+                zs = model.forward_language(ys.t(), yn)
 
-            zs = model.forward_joint(xs, zs)
+                zs = model.forward_joint(xs, zs)
 
             nll = rnnt_loss(zs, ys, xn, yn)
 
@@ -202,7 +206,8 @@ for epoch in range(1, 11):
 
         for xs, ys, xn, yn in test:
 
-            zs, xs, xn = model(xs, ys.t(), xn, yn)
+            with torch.autocast('cuda', dtype=torch.bfloat16):
+                zs, xs, xn = model(xs, ys.t(), xn, yn)
 
             loss1 = rnnt_loss(zs, ys, xn, yn, average_frames=False, reduction="mean")
 
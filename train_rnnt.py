@@ -59,7 +59,8 @@ for epoch in range(1, 11):
 
         step += 1
 
-        zs, xs, xn = model(xs, ys.t(), xn, yn)
+        with torch.autocast('cuda', dtype=torch.bfloat16):
+            zs, xs, xn = model(xs, ys.t(), xn, yn)
 
         loss1 = rnnt_loss(zs, ys, xn, yn, average_frames=False, reduction="mean")
 
@@ -113,7 +114,8 @@ for epoch in range(1, 11):
 
         for xs, ys, xn, yn in dev:
 
-            xs, xn = model.forward_acoustic(xs, xn)
+            with torch.autocast('cuda', dtype=torch.bfloat16):
+                xs, xn = model.forward_acoustic(xs, xn)
 
             xs = model.greedy_decode(xs, argmax=False)
 
@@ -132,7 +134,8 @@ for epoch in range(1, 11):
 
         for xs, ys, xn, yn in test:
 
-            zs, xs, xn = model(xs, ys.t(), xn, yn)
+            with torch.autocast('cuda', dtype=torch.bfloat16):
+                zs, xs, xn = model(xs, ys.t(), xn, yn)
 
             loss1 = rnnt_loss(zs, ys, xn, yn, average_frames=False, reduction="mean")
 